@@ -1,11 +1,31 @@
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
 import pandas as pd
 import yfinance as yf
+import matplotlib
+# Use the non-interactive Agg backend; plots are only ever saved to disk.
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import logging
-from typing import Tuple, List, Dict
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener
+from typing import Tuple, List, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import time
+import pickle
+
+# Prefer orjson for parsing API responses; fall back to the standard library.
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    import json
+    json_loads = json.loads
 
 # Create data folder if it doesn't exist.
 data_dir = "data"
@@ -20,11 +40,65 @@ fh = logging.FileHandler('nse_data.log', mode='a')
 fh.setLevel(logging.INFO)
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 fh.setFormatter(formatter)
-logger.addHandler(fh)
+
+# Route records through an in-memory queue; a background listener writes them to the file.
+log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+logger.addHandler(QueueHandler(log_queue))
+listener = QueueListener(log_queue, fh)
+listener.start()
+atexit.register(listener.stop)
 
 # Disable propagation so logs are not printed to terminal.
 logger.propagate = False
 
+# File used to persist NSE session cookies between runs.
+cookie_path = os.path.join(data_dir, ".nse_cookies.pkl")
+
+# Create cache folder for yfinance histories if it doesn't exist.
+cache_dir = os.path.join(data_dir, ".cache")
+os.makedirs(cache_dir, exist_ok=True)
+
+@lru_cache(maxsize=None)
+def _get_ticker(sym: str) -> yf.Ticker:
+    """
+    Returns a cached yfinance Ticker for the symbol, creating it on first use.
+    Tickers are kept for the lifetime of the process.
+    """
+    return yf.Ticker(sym)
+
+
+def _close_only(hist: pd.DataFrame) -> pd.DataFrame:
+    """
+    Normalizes a yfinance history to a float32 Close column on a sorted,
+    duplicate-free tz-naive index, so batched, per-symbol and cached frames
+    all share the same shape and can be stacked.
+    """
+    hist = hist[["Close"]].astype('float32')
+    if isinstance(hist.index, pd.DatetimeIndex) and hist.index.tz is not None:
+        hist.index = hist.index.tz_localize(None)
+    return hist[~hist.index.duplicated(keep='last')].sort_index()
+
+
+def _market_today() -> pd.Timestamp:
+    """
+    Returns today's date in exchange time (IST) as a tz-naive Timestamp.
+    """
+    return pd.Timestamp.now(tz="Asia/Kolkata").normalize().tz_localize(None)
+
+
+def _top_k_indices(values: np.ndarray, k: int) -> np.ndarray:
+    """
+    Returns the indices of the k largest values, ordered largest first.
+    Uses np.argpartition so only the selected k values are sorted.
+    """
+    if k <= 0 or values.size == 0:
+        return np.empty(0, dtype=int)
+    if k < values.size:
+        idx = np.argpartition(-values, k - 1)[:k]
+    else:
+        idx = np.arange(values.size)
+    return idx[np.argsort(-values[idx], kind='stable')]
+
 
 class NSEDataFetcher:
     """
@@ -51,14 +125,61 @@ class NSEDataFetcher:
             "Sec-Fetch-Mode": "cors",
             "Sec-Fetch-Site": "same-origin"
         }
+        # Send the browser headers on every request and reuse pooled connections with retries.
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=64, pool_maxsize=64,
+                              max_retries=Retry(total=3, backoff_factor=0.3,
+                                                status_forcelist=[429, 500, 502, 503, 504]))
+        self.session.mount("https://", adapter)
+        self._load_cookies()
+        if self._has_valid_cookie():
+            logging.info("Reusing saved NSE session cookies.")
+            return
+        self._prime_session()
+
+    def _prime_session(self) -> None:
+        """
+        Primes the session cookies by accessing the specified URL and saves them.
+        """
         try:
             logging.info("Initializing session by accessing specified URL...")
             # Prime the session by accessing the specified URL.
             self.session.get("https://www.nseindia.com/market-data/live-equity-market?symbol=NIFTY%2050",
-                             headers=self.headers, timeout=10)
+                             timeout=10)
         except Exception as e:
             logging.error("Error initiating session: %s", e)
             raise
+        self._save_cookies()
+
+    def _load_cookies(self) -> None:
+        """
+        Loads session cookies saved by a previous run, if any.
+        """
+        try:
+            with open(cookie_path, "rb") as f:
+                self.session.cookies.update(pickle.load(f))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning("Could not load saved cookies: %s", e)
+
+    def _save_cookies(self) -> None:
+        """
+        Saves the session cookies so later runs can skip priming.
+        """
+        try:
+            with open(cookie_path, "wb") as f:
+                pickle.dump(self.session.cookies, f)
+        except Exception as e:
+            logging.warning("Could not save cookies: %s", e)
+
+    def _has_valid_cookie(self) -> bool:
+        """
+        Returns True if the session holds an unexpired 'nsit' cookie.
+        Session-only cookies (no expiry) are not reused across runs.
+        """
+        return any(c.name == "nsit" and c.expires is not None and not c.is_expired()
+                   for c in self.session.cookies)
 
     def fetch_live_data(self) -> pd.DataFrame:
         """
@@ -70,30 +191,41 @@ class NSEDataFetcher:
         """
         try:
             logging.info("Requesting live data from NSE API...")
-            response = self.session.get(self.api_url, headers=self.headers, timeout=10)
+            response = self.session.get(self.api_url, timeout=10)
+            if response.status_code in (401, 403):
+                # Saved cookies were rejected; re-prime the session and retry once.
+                logging.warning("NSE API returned %d; re-priming session.", response.status_code)
+                self.session.cookies.clear()
+                self._prime_session()
+                response = self.session.get(self.api_url, timeout=10)
             response.raise_for_status()
-            data = response.json()
+            data = json_loads(response.content)
             if "data" not in data:
                 raise Exception("Expected key 'data' not found in JSON response.")
-            df = pd.DataFrame(data["data"])
+            df = pd.DataFrame.from_records(data["data"])
+            # Persist any cookies NSE rotated on the API response.
+            self._save_cookies()
             logging.info("Live data fetched successfully with %d records.", len(df))
             return df
         except Exception as e:
             logging.error("Error fetching live data: %s", e)
             raise
 
-    def get_nifty50_symbols(self) -> List[str]:
+    def get_nifty50_symbols(self, df: Optional[pd.DataFrame] = None) -> List[str]:
         """
         Extracts the list of stock symbols from the live data.
+        Args:
+            df (pd.DataFrame, optional): Previously fetched live data. If omitted,
+                the live data is fetched again.
         Returns:
             List[str]: Stock symbols appended with ".NS" for yfinance.
         """
         try:
-            df = self.fetch_live_data()
+            if df is None:
+                df = self.fetch_live_data()
             if "symbol" not in df.columns:
                 raise Exception("Expected 'symbol' column not found in data.")
-            symbols = df["symbol"].tolist()
-            symbols = [sym + ".NS" for sym in symbols]
+            symbols = (df["symbol"].astype(str) + ".NS").tolist()
             logging.info("Extracted %d symbols.", len(symbols))
             return symbols
         except Exception as e:
@@ -105,26 +237,139 @@ class NSEDataAnalyzer:
     """
     Analyzes NSE data using live data and historical data from yfinance.
     """
-    def __init__(self, symbols: List[str]):
+    def __init__(self, symbols: List[str], ttl_days: int = 1):
         self.symbols = symbols
+        self.ttl_days = ttl_days
+        self._fig = None
+        self._ax = None
+        self._prune_cache()
+
+    def _prune_cache(self) -> None:
+        """
+        Removes cached history files older than ttl_days (by modification time).
+        Symbols whose file was removed get their full history downloaded again.
+        """
+        cutoff = time.time() - self.ttl_days * 86400
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError as e:
+                logging.warning("Could not prune cache file %s: %s", path, e)
+
+    def _cache_path(self, sym: str, period: str) -> str:
+        """
+        Returns the cache file path for a symbol and period.
+        """
+        return os.path.join(cache_dir, f"{sym}_{period}.parquet")
 
     def fetch_yfinance_data(self, period: str = "1y") -> Dict[str, pd.DataFrame]:
         """
         Fetches historical data for all symbols using yfinance.
+        Cached symbols hold completed days only, so just the bars since the
+        cached data are downloaded; the rest get a full batched download.
+        Only the Close column is kept, as float32.
         """
         data: Dict[str, pd.DataFrame] = {}
+        cached: Dict[str, pd.DataFrame] = {}
+        to_download: List[str] = []
         for sym in self.symbols:
-            try:
-                logging.info("Fetching historical data for %s...", sym)
-                ticker = yf.Ticker(sym)
-                hist = ticker.history(period=period)
-                if hist.empty:
-                    logging.warning("No historical data for %s", sym)
-                else:
+            path = self._cache_path(sym, period)
+            if os.path.exists(path):
+                try:
+                    hist = _close_only(pd.read_parquet(path))
+                    if not hist.empty:
+                        cached[sym] = hist
+                        continue
+                except Exception as e:
+                    logging.warning("Could not read cache for %s: %s", sym, e)
+            to_download.append(sym)
+        logging.info("Loaded %d symbols from cache.", len(cached))
+
+        if cached:
+            # Fetch the bars after the oldest cached day, including today's.
+            start = min(hist.index.max() for hist in cached.values()) + pd.Timedelta(days=1)
+            logging.info("Refreshing latest data for %d cached symbols...", len(cached))
+            recent = self._download_batch(list(cached), start=start.strftime('%Y-%m-%d'))
+            if recent is None:
+                logging.warning("Could not refresh cached symbols; downloading full history.")
+                to_download.extend(cached)
+            else:
+                for sym, hist in cached.items():
+                    latest = recent.get(sym)
+                    if latest is not None:
+                        hist = pd.concat([hist, latest[latest.index > hist.index.max()]])
                     data[sym] = hist
+
+        if to_download:
+            logging.info("Fetching historical data for %d symbols...", len(to_download))
+            fetched = self._download_batch(to_download, period=period) or {}
+            missing = [sym for sym in to_download if sym not in fetched]
+            if missing:
+                # Retry symbols the batch did not return, one request each, concurrently.
+                with ThreadPoolExecutor(max_workers=16) as ex:
+                    for sym, hist in ex.map(lambda s: self._fetch_one(s, period), missing):
+                        if hist is not None:
+                            fetched[sym] = hist
+
+            # Today's bar may still change, so only completed days are cached.
+            today = _market_today()
+            for sym, hist in fetched.items():
+                past = hist[hist.index < today]
+                if past.empty:
+                    continue
+                try:
+                    past.to_parquet(self._cache_path(sym, period))
+                except Exception as e:
+                    logging.warning("Could not write cache for %s: %s", sym, e)
+            data.update(fetched)
+        return {sym: data[sym] for sym in self.symbols if sym in data}
+
+    def _download_batch(self, symbols: List[str], **kwargs) -> Optional[Dict[str, pd.DataFrame]]:
+        """
+        Downloads history for several symbols in one batched yfinance request and
+        splits the column-MultiIndex result into one Close frame per symbol.
+        Symbols without rows are left out; returns None if the request fails
+        or its columns cannot be split per symbol.
+        """
+        try:
+            raw = yf.download(symbols, group_by='ticker', threads=True,
+                              progress=False, auto_adjust=True, **kwargs)
+        except Exception as e:
+            logging.error("Error fetching batched historical data: %s", e)
+            return None
+        # Single-ticker downloads may come back with flat columns.
+        if not isinstance(raw.columns, pd.MultiIndex):
+            return None
+        result: Dict[str, pd.DataFrame] = {}
+        for sym in symbols:
+            try:
+                if sym not in raw.columns.levels[0]:
+                    continue
+                hist = raw[sym].dropna(how='all')
+                if not hist.empty:
+                    result[sym] = _close_only(hist)
             except Exception as e:
                 logging.error("Error fetching data for %s: %s", sym, e)
-        return data
+        return result
+
+    def _fetch_one(self, sym: str, period: str) -> Tuple[str, Optional[pd.DataFrame]]:
+        """
+        Fetches historical data for a single symbol.
+        Returns (sym, None) if the request fails or yields no data.
+        """
+        try:
+            logging.info("Fetching historical data for %s...", sym)
+            # Match the batched download: adjusted prices, normalized by _close_only.
+            hist = _get_ticker(sym).history(period=period, auto_adjust=True)
+            if hist.empty:
+                logging.warning("No historical data for %s", sym)
+                return sym, None
+            return sym, _close_only(hist)
+        except Exception as e:
+            logging.error("Error fetching data for %s: %s", sym, e)
+            return sym, None
 
     def get_top_gainers_losers(self, live_df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
         """
@@ -132,87 +377,122 @@ class NSEDataAnalyzer:
         NOTE: Instead of '%change', we use 'pChange' as per the table header.
         """
         try:
-            live_df["pChange"] = live_df["pChange"].astype(str).str.replace('%', '').astype(float)
-            gainers = live_df.sort_values("pChange", ascending=False).head(5)
-            losers = live_df.sort_values("pChange", ascending=True).head(5)
+            col = live_df["pChange"]
+            # NSE normally returns pChange as a number; only strip '%' from string values.
+            if not pd.api.types.is_numeric_dtype(col):
+                live_df["pChange"] = pd.to_numeric(col.astype(str).str.rstrip('%'), errors='coerce')
+            gainers = live_df.nlargest(5, "pChange")
+            losers = live_df.nsmallest(5, "pChange")
             logging.info("Identified top gainers and losers.")
             return gainers, losers
         except Exception as e:
             logging.error("Error computing top gainers/losers: %s", e)
             raise
 
-    def get_52week_analysis(self, hist_data: Dict[str, pd.DataFrame]) -> Tuple[List[Tuple[str, float, float]], List[Tuple[str, float, float]]]:
+    def stack_closes(self, hist_data: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+        """
+        Combines the per-symbol histories into one frame with (symbol, field)
+        MultiIndex columns and returns its Close slice
+        (index=date, columns=symbols) for the vectorized analyses.
+        """
+        if not hist_data:
+            return pd.DataFrame()
+        try:
+            combined = pd.concat(hist_data, axis=1)
+            return combined.xs("Close", level=1, axis=1)
+        except Exception as e:
+            logging.error("Error stacking close prices: %s", e)
+            return pd.DataFrame()
+
+    def get_52week_analysis(self, closes: pd.DataFrame) -> Tuple[List[Tuple[str, float, float]], List[Tuple[str, float, float]]]:
         """
         Identifies 5 stocks trading at least 30% below their 52-week high and
         5 stocks trading at least 20% above their 52-week low.
+        Expects the Close matrix produced by stack_closes().
         """
-        below_high: List[Tuple[str, float, float]] = []
-        above_low: List[Tuple[str, float, float]] = []
-        for sym, df in hist_data.items():
-            try:
-                if df.empty:
-                    continue
-                current_price = df["Close"].iloc[-1]
-                high_52w = df["Close"].max()
-                low_52w = df["Close"].min()
-                if current_price <= 0.70 * high_52w:
-                    below_high.append((sym, current_price, high_52w))
-                if current_price >= 1.20 * low_52w:
-                    above_low.append((sym, current_price, low_52w))
-            except Exception as e:
-                logging.error("Error in 52-week analysis for %s: %s", sym, e)
-                continue
-        below_high = sorted(below_high, key=lambda x: x[1] / x[2])[:5]
-        above_low = sorted(above_low, key=lambda x: -(x[1] / x[2]))[:5]
-        return below_high, above_low
+        try:
+            closes = closes.dropna(axis=1, how='all')
+            if closes.empty:
+                return [], []
+            syms = closes.columns.to_numpy()
+            vals = closes.ffill().to_numpy(dtype=float)
+            current = vals[-1]
+            highs = np.nanmax(vals, axis=0)
+            lows = np.nanmin(vals, axis=0)
+            ratio_high = current / highs
+            ratio_low = current / lows
+            below_idx = np.flatnonzero(ratio_high <= 0.70)
+            below_idx = below_idx[_top_k_indices(-ratio_high[below_idx], 5)]
+            above_idx = np.flatnonzero(ratio_low >= 1.20)
+            above_idx = above_idx[_top_k_indices(ratio_low[above_idx], 5)]
+            below_high = [(syms[i], float(current[i]), float(highs[i])) for i in below_idx]
+            above_low = [(syms[i], float(current[i]), float(lows[i])) for i in above_idx]
+            return below_high, above_low
+        except Exception as e:
+            logging.error("Error in 52-week analysis: %s", e)
+            return [], []
 
-    def get_30day_returns(self, hist_data: Dict[str, pd.DataFrame]) -> List[Tuple[str, float]]:
+    def get_30day_returns(self, closes: pd.DataFrame, top_n: int = 5) -> List[Tuple[str, float]]:
         """
-        Calculates the highest 30-day returns for each symbol.
+        Calculates 30-day returns and returns the top_n symbols, highest first.
+        Symbols with fewer than 30 closing prices are skipped.
+        Expects the Close matrix produced by stack_closes().
         """
-        returns: List[Tuple[str, float]] = []
-        for sym, df in hist_data.items():
-            try:
-                if df.shape[0] < 30:
-                    continue
-                current_price = df["Close"].iloc[-1]
-                price_30d_ago = df["Close"].iloc[-30]
-                ret = ((current_price - price_30d_ago) / price_30d_ago) * 100
-                returns.append((sym, ret))
-            except Exception as e:
-                logging.error("Error computing 30-day return for %s: %s", sym, e)
-                continue
-        returns = sorted(returns, key=lambda x: x[1], reverse=True)
-        return returns
+        try:
+            closes = closes.loc[:, closes.count() >= 30]
+            if closes.shape[1] == 0:
+                return []
+            syms = closes.columns.to_numpy()
+            vals = closes.ffill().to_numpy(dtype=float)
+            rets = (vals[-1] / vals[-30] - 1) * 100
+            valid = ~np.isnan(rets)
+            syms, rets = syms[valid], rets[valid]
+            return [(syms[i], float(rets[i])) for i in _top_k_indices(rets, top_n)]
+        except Exception as e:
+            logging.error("Error computing 30-day returns: %s", e)
+            return []
 
     def plot_gainers_losers(self, gainers: pd.DataFrame, losers: pd.DataFrame) -> None:
         """
         Plots bar charts for the top 5 gainers and losers.
-        Saves the plot as an image file in the data folder and then closes the plot automatically.
+        Saves the plot as an image file in the data folder. The figure is created
+        on the first call and reused afterwards; call close_plots() when done.
         """
         try:
-            fig, ax = plt.subplots(1, 2, figsize=(15, 6))
-            ax[0].bar(gainers["symbol"], gainers["pChange"].astype(float), color='green')
+            if self._fig is None:
+                self._fig, self._ax = plt.subplots(1, 2, figsize=(15, 6))
+            else:
+                self._ax[0].clear()
+                self._ax[1].clear()
+            ax = self._ax
+            ax[0].bar(gainers["symbol"], gainers["pChange"], color='green')
             ax[0].set_title("Top 5 Gainers")
             ax[0].set_xlabel("Symbol")
             ax[0].set_ylabel("% Change")
             ax[0].tick_params(axis='x', rotation=45)
             
-            ax[1].bar(losers["symbol"], losers["pChange"].astype(float), color='red')
+            ax[1].bar(losers["symbol"], losers["pChange"], color='red')
             ax[1].set_title("Top 5 Losers")
             ax[1].set_xlabel("Symbol")
             ax[1].set_ylabel("% Change")
             ax[1].tick_params(axis='x', rotation=45)
             
-            plt.tight_layout()
+            self._fig.tight_layout()
             plot_path = os.path.join(data_dir, "gainers_losers.png")
-            plt.savefig(plot_path)
-            plt.close('all')
-            logging.info("Bar charts saved to %s and closed automatically.", plot_path)
+            self._fig.savefig(plot_path)
+            logging.info("Bar charts saved to %s.", plot_path)
         except Exception as e:
             logging.error("Error plotting bar charts: %s", e)
             raise
 
+    def close_plots(self) -> None:
+        """
+        Closes all figures, including the reused gainers/losers figure.
+        """
+        plt.close('all')
+        self._fig = None
+        self._ax = None
+
 
 def main():
     output_lines = []
@@ -222,7 +502,7 @@ def main():
         live_df = fetcher.fetch_live_data()
         
         # Extract stock symbols (appending '.NS' for yfinance).
-        nifty50_symbols = fetcher.get_nifty50_symbols()
+        nifty50_symbols = fetcher.get_nifty50_symbols(live_df)
         
         # Instantiate the data analyzer.
         analyzer = NSEDataAnalyzer(nifty50_symbols)
@@ -230,22 +510,25 @@ def main():
         # Compute top gainers and losers.
         gainers, losers = analyzer.get_top_gainers_losers(live_df)
         output_lines.append("----- Top 5 Gainers -----")
-        for idx, row in gainers.iterrows():
-            line = f"Symbol: {row['symbol']}, % Change: {row['pChange']:.2f}%"
-            output_lines.append(line)
+        output_lines.extend(
+            f"Symbol: {sym}, % Change: {pchg:.2f}%"
+            for sym, pchg in zip(gainers["symbol"].to_numpy(), gainers["pChange"].to_numpy())
+        )
         output_lines.append("-------------------------\n")
         
         output_lines.append("----- Top 5 Losers -----")
-        for idx, row in losers.iterrows():
-            line = f"Symbol: {row['symbol']}, % Change: {row['pChange']:.2f}%"
-            output_lines.append(line)
+        output_lines.extend(
+            f"Symbol: {sym}, % Change: {pchg:.2f}%"
+            for sym, pchg in zip(losers["symbol"].to_numpy(), losers["pChange"].to_numpy())
+        )
         output_lines.append("-------------------------\n")
         
         # Fetch historical data (using 1 year).
         hist_data = analyzer.fetch_yfinance_data(period="1y")
+        closes = analyzer.stack_closes(hist_data)
         
         # 52-week analysis.
-        below_high, above_low = analyzer.get_52week_analysis(hist_data)
+        below_high, above_low = analyzer.get_52week_analysis(closes)
         output_lines.append("----- Stocks 30% Below 52-Week High -----")
         for sym, current, high in below_high:
             line = f"Symbol: {sym}, Current Price: {current:.2f}, 52-Week High: {high:.2f}"
@@ -259,9 +542,9 @@ def main():
         output_lines.append("----------------------------------------\n")
         
         # 30-day returns.
-        returns_30d = analyzer.get_30day_returns(hist_data)
+        returns_30d = analyzer.get_30day_returns(closes)
         output_lines.append("----- Top 5 Stocks by 30-Day Return -----")
-        for sym, ret in returns_30d[:5]:
+        for sym, ret in returns_30d:
             line = f"Symbol: {sym}, 30-Day Return: {ret:.2f}%"
             output_lines.append(line)
         output_lines.append("-----------------------------------------\n")
@@ -269,17 +552,16 @@ def main():
         # Save the output text to a file.
         results_path = os.path.join(data_dir, "results.txt")
         with open(results_path, "w") as f:
-            f.write("\n".join(output_lines))
+            f.writelines(line + "\n" for line in output_lines)
         logging.info("Text output saved to %s", results_path)
         
         # Plot and save the gainers and losers.
         analyzer.plot_gainers_losers(gainers, losers)
+        analyzer.close_plots()
         
-        # Optionally, re-read the saved file and print its content
+        # Print the same content that was written to results.txt.
         print("\n----- Results from results.txt -----")
-        with open(results_path, "r") as f:
-            file_content = f.read()
-            print(file_content)
+        print("\n".join(output_lines))
         
         
     except Exception as e: